@@ -1,23 +1,105 @@
+import asyncio
 import base64
-import io
 import os
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, List, Optional
 
+import cv2
+import httpx
 import numpy as np
-from fastapi import FastAPI, Header, HTTPException
+from aiolimiter import AsyncLimiter
+from fastapi import FastAPI, File, Header, HTTPException, UploadFile
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from PIL import Image
-import requests
 from paddleocr import PaddleOCR
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+# Importing paddleocr puts its bundled tools/ package on sys.path; reuse
+# TextSystem's reading-order sort and crop rectification from it.
+from tools.infer.predict_system import sorted_boxes
+from tools.infer.utility import get_rotate_crop_image
 
 OCR_TOKEN = os.getenv("OCR_SERVICE_TOKEN", "")
 OCR_LANG = os.getenv("OCR_LANG", "en")
 OCR_MAX_WIDTH = int(os.getenv("OCR_MAX_WIDTH", "1024"))
 OCR_USE_GPU = os.getenv("OCR_USE_GPU", "false").lower() in ("1", "true", "yes")
+OCR_USE_ANGLE_CLS = os.getenv("OCR_USE_ANGLE_CLS", "true").lower() in ("1", "true", "yes")
+OCR_REC_BATCH_NUM = int(os.getenv("OCR_REC_BATCH_NUM", "16"))
+OCR_ENABLE_HPI = os.getenv("OCR_ENABLE_HPI", "false").lower() in ("1", "true", "yes")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "1"))
+OCR_CPU_THREADS = int(os.getenv("OCR_CPU_THREADS", str(max(1, (os.cpu_count() or 1) // OCR_WORKERS))))
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", str(max(1, (os.cpu_count() or 1) // OCR_WORKERS))))
+OCR_WARMUP_RUNS = int(os.getenv("OCR_WARMUP_RUNS", "2"))
+OCR_FETCH_RPS = int(os.getenv("OCR_FETCH_RPS", "20"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+FETCH_BACKOFF_MAX = 4
+
+
+def _engine_options() -> dict:
+    options = {
+        "use_angle_cls": OCR_USE_ANGLE_CLS,
+        "lang": OCR_LANG,
+        "use_gpu": OCR_USE_GPU,
+        "rec_batch_num": OCR_REC_BATCH_NUM,
+        # PaddleOCR defaults to 10 threads per predictor regardless of how many
+        # workers share the host.
+        "cpu_threads": OCR_CPU_THREADS,
+    }
+    if OCR_ENABLE_HPI:
+        # PaddleOCR 2.7 has no enable_hpi switch; these are the inference
+        # backend options it does expose for the same effect.
+        if OCR_USE_GPU:
+            options.update(use_tensorrt=True, precision="fp16")
+        else:
+            options.update(enable_mkldnn=True)
+    return options
+
+
+ocr_engine = PaddleOCR(**_engine_options())
+
+# Downloads and decodes overlap across images, but the Paddle predictors are
+# not thread-safe, so engine calls are serialized on a single worker.
+_image_pool = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY)
+_ocr_pool = ThreadPoolExecutor(max_workers=1)
+_ocr_semaphore = asyncio.Semaphore(OCR_CONCURRENCY)
+
+_http_client: Optional[httpx.AsyncClient] = None
+# OCR_FETCH_RPS is the limit for the whole service, shared by the workers.
+_fetch_limiter = AsyncLimiter(max_rate=OCR_FETCH_RPS / OCR_WORKERS, time_period=1)
+
+
+def _warmup_engine():
+    # Rendered text rather than a blank frame, so detection finds boxes and the
+    # cls/rec predictors get warmed up too.
+    image = np.full((640, 640, 3), 255, dtype=np.uint8)
+    cv2.putText(image, "TEN KINGS 2026", (40, 320), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 4)
+    for _ in range(OCR_WARMUP_RUNS):
+        _, crops = _detect(image)
+        _recognize(crops)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global _http_client
+    # oneDNN/TensorRT caches are per thread, so warm up on the thread that
+    # serves inference.
+    await asyncio.get_running_loop().run_in_executor(_ocr_pool, _warmup_engine)
+    _http_client = httpx.AsyncClient(
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )
+    try:
+        yield
+    finally:
+        await _http_client.aclose()
 
-ocr_engine = PaddleOCR(use_angle_cls=True, lang=OCR_LANG, use_gpu=OCR_USE_GPU)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 class OcrImage(BaseModel):
@@ -28,6 +110,9 @@ class OcrImage(BaseModel):
 
 class OcrRequest(BaseModel):
     images: List[OcrImage]
+    # Callers sending pre-aligned images (e.g. variant-corner-service
+    # "perspective" output) can pass false to skip angle classification.
+    cls: Optional[bool] = None
 
 
 class OcrPoint(BaseModel):
@@ -64,79 +149,188 @@ def _check_auth(auth_header: Optional[str]):
         raise HTTPException(status_code=403, detail="Invalid auth")
 
 
-def _load_image(item: OcrImage) -> Image.Image:
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+_fetch_backoff = wait_exponential_jitter(initial=0.25, max=FETCH_BACKOFF_MAX)
+
+
+def _fetch_wait(retry_state) -> float:
+    # Honour the origin's Retry-After, capped like the exponential backoff so
+    # one slow origin cannot stall a request.
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = _retry_after(exc.response)
+        if retry_after is not None:
+            return min(retry_after, FETCH_BACKOFF_MAX)
+    return _fetch_backoff(retry_state)
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_fetch_wait,
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+async def _fetch_image(client: httpx.AsyncClient, url: str) -> bytes:
+    async with _fetch_limiter:
+        resp = await client.get(url)
+    resp.raise_for_status()
+    return resp.content
+
+
+async def _load_image_async(item: OcrImage, client: httpx.AsyncClient) -> bytes:
     if item.base64:
-        data = base64.b64decode(item.base64)
-        return Image.open(io.BytesIO(data)).convert("RGB")
+        return base64.b64decode(item.base64)
     if item.url:
-        resp = requests.get(item.url, timeout=10)
-        resp.raise_for_status()
-        return Image.open(io.BytesIO(resp.content)).convert("RGB")
+        return await _fetch_image(client, item.url)
     raise HTTPException(status_code=400, detail="Image must include url or base64")
 
 
-def _resize_image(image: Image.Image) -> Image.Image:
-    width, height = image.size
+def _load_image(data: bytes) -> np.ndarray:
+    # PaddleOCR reads its own inputs with cv2, so BGR is the channel order it expects.
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    return image
+
+
+def _resize_image(image: np.ndarray) -> np.ndarray:
+    height, width = image.shape[:2]
     if width <= OCR_MAX_WIDTH:
         return image
     ratio = OCR_MAX_WIDTH / float(width)
     new_height = int(height * ratio)
-    return image.resize((OCR_MAX_WIDTH, new_height), Image.BILINEAR)
+    return cv2.resize(image, (OCR_MAX_WIDTH, new_height), interpolation=cv2.INTER_AREA)
+
+
+def _preprocess(data: bytes) -> np.ndarray:
+    return _resize_image(_load_image(data))
+
+
+def _detect(array: np.ndarray):
+    dt_boxes, _ = ocr_engine.text_detector(array)
+    if dt_boxes is None or len(dt_boxes) == 0:
+        return [], []
+    boxes = sorted_boxes(dt_boxes)
+    return boxes, [get_rotate_crop_image(array, box) for box in boxes]
+
 
+def _recognize(crops: List[np.ndarray], cls: bool = OCR_USE_ANGLE_CLS):
+    # One classifier/recognizer pass over the text lines of every image in the
+    # request, so they share rec_batch_num-sized batches.
+    if not crops:
+        return []
+    if cls and ocr_engine.use_angle_cls:
+        crops, _, _ = ocr_engine.text_classifier(crops)
+    rec_res, _ = ocr_engine.text_recognizer(crops)
+    return rec_res
 
-def _run_ocr(image: Image.Image, image_id: Optional[str] = None):
-    image = _resize_image(image)
-    array = np.array(image)
-    result = ocr_engine.ocr(array, cls=True)
+
+def _parse_result(boxes: List[np.ndarray], rec_res, image_id: Optional[str] = None) -> dict:
     lines = []
-    confidences = []
-    tokens: List[OcrToken] = []
-    for entry in result:
-        if not entry:
+    conf_sum = 0.0
+    conf_count = 0
+    # Results are built as plain dicts in the OcrResult/OcrToken shape; the
+    # models only document the schema, so no per-point validation runs here.
+    tokens: List[dict] = []
+    for box, (text, conf) in zip(boxes, rec_res):
+        conf = float(conf)
+        if not text or conf < ocr_engine.drop_score:
             continue
-        for line in entry:
-            text = line[1][0]
-            conf = float(line[1][1])
-            raw_bbox = line[0] if isinstance(line, (list, tuple)) and len(line) > 0 else []
-            bbox_points: List[OcrPoint] = []
-            if isinstance(raw_bbox, (list, tuple)):
-                for point in raw_bbox:
-                    if isinstance(point, (list, tuple)) and len(point) >= 2:
-                        try:
-                            bbox_points.append(OcrPoint(x=float(point[0]), y=float(point[1])))
-                        except Exception:
-                            continue
-            if text:
-                lines.append(text)
-                confidences.append(conf)
-                tokens.append(
-                    OcrToken(
-                        text=text,
-                        confidence=conf,
-                        bbox=bbox_points,
-                        image_id=image_id,
-                    )
-                )
+        lines.append(text)
+        conf_sum += conf
+        conf_count += 1
+        tokens.append(
+            {
+                "text": text,
+                "confidence": conf,
+                "bbox": [{"x": float(x), "y": float(y)} for x, y in box],
+                "image_id": image_id,
+            }
+        )
     text = "\n".join(lines).strip()
-    confidence = float(np.mean(confidences)) if confidences else 0.0
-    return text, confidence, tokens
+    confidence = conf_sum / conf_count if conf_count else 0.0
+    return {"id": image_id, "text": text, "confidence": confidence, "tokens": tokens}
+
+
+async def _detect_image(data: Awaitable[bytes]):
+    loop = asyncio.get_running_loop()
+    async with _ocr_semaphore:
+        array = await loop.run_in_executor(_image_pool, _preprocess, await data)
+        return await loop.run_in_executor(_ocr_pool, _detect, array)
+
+
+async def _ocr_images(
+    ids: List[Optional[str]], sources: List[Awaitable[bytes]], cls: Optional[bool] = None
+) -> ORJSONResponse:
+    # Detection runs per image as each download lands; recognition then runs
+    # once over the crops of all images and is split back by box count.
+    loop = asyncio.get_running_loop()
+    use_cls = OCR_USE_ANGLE_CLS if cls is None else cls
+    detections = await asyncio.gather(*[_detect_image(data) for data in sources])
+    crops = [crop for _, image_crops in detections for crop in image_crops]
+    rec_res = await loop.run_in_executor(_ocr_pool, _recognize, crops, use_cls)
+
+    results = []
+    offset = 0
+    for image_id, (boxes, _) in zip(ids, detections):
+        results.append(_parse_result(boxes, rec_res[offset : offset + len(boxes)], image_id))
+        offset += len(boxes)
+    return _build_response(results)
+
+
+def _build_response(results: List[dict]) -> ORJSONResponse:
+    combined_parts = []
+    for result in results:
+        if result["text"]:
+            if result["id"]:
+                combined_parts.append(f"[{result['id']}]\n{result['text']}")
+            else:
+                combined_parts.append(result["text"])
+
+    combined_text = "\n\n".join(combined_parts).strip()
+    # Returning the response directly skips response_model re-validation.
+    return ORJSONResponse({"results": results, "combined_text": combined_text})
 
 
 @app.post("/ocr", response_model=OcrResponse)
 async def ocr_endpoint(payload: OcrRequest, authorization: Optional[str] = Header(default=None)):
     _check_auth(authorization)
-    results: List[OcrResult] = []
-    combined_parts = []
+    return await _ocr_images(
+        [item.id for item in payload.images],
+        [_load_image_async(item, _http_client) for item in payload.images],
+        payload.cls,
+    )
 
-    for item in payload.images:
-        image = _load_image(item)
-        text, confidence, tokens = _run_ocr(image, item.id)
-        results.append(OcrResult(id=item.id, text=text, confidence=confidence, tokens=tokens))
-        if text:
-            if item.id:
-                combined_parts.append(f"[{item.id}]\n{text}")
-            else:
-                combined_parts.append(text)
 
-    combined_text = "\n\n".join(combined_parts).strip()
-    return OcrResponse(results=results, combined_text=combined_text)
+@app.post("/ocr/raw", response_model=OcrResponse)
+async def ocr_raw_endpoint(
+    files: List[UploadFile] = File(...),
+    cls: Optional[bool] = None,
+    authorization: Optional[str] = Header(default=None),
+):
+    # Multipart variant of /ocr for internal callers that already hold the
+    # image bytes; each part's filename is used as the image id.
+    _check_auth(authorization)
+    return await _ocr_images([file.filename for file in files], [file.read() for file in files], cls)
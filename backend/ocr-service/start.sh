@@ -0,0 +1,26 @@
+#!/bin/sh
+set -e
+
+# Paddle's GPU predictor is not fork-safe, so GPU deployments run a single
+# worker and rely on the in-process OCR pool instead.
+case "$(echo "${OCR_USE_GPU:-false}" | tr '[:upper:]' '[:lower:]')" in
+  1|true|yes)
+    exec uvicorn app:app --host 0.0.0.0 --port 7001 --workers 1
+    ;;
+esac
+
+# The service shares its host, so scale out explicitly via OCR_WORKERS. app.py
+# splits OCR_CPU_THREADS, OCR_CONCURRENCY and OCR_FETCH_RPS across the workers.
+export OCR_WORKERS="${OCR_WORKERS:-1}"
+if [ "$OCR_WORKERS" -le 1 ]; then
+  exec uvicorn app:app --host 0.0.0.0 --port 7001 --workers 1
+fi
+
+# PaddleOCR is built at import time, so --preload constructs it once in the
+# gunicorn master and the forked workers share its weights copy-on-write.
+exec gunicorn app:app \
+  --worker-class uvicorn_worker.UvicornWorker \
+  --preload \
+  --workers "$OCR_WORKERS" \
+  --bind 0.0.0.0:7001 \
+  --timeout 120
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import httpx
+
+# Building the real engine downloads model weights; the stages that use it are
+# patched per test instead.
+with patch("paddleocr.PaddleOCR"):
+    import app
+
+
+def box(marker):
+    return [[marker, 0], [marker + 1, 0], [marker + 1, 1], [marker, 1]]
+
+
+async def source(data):
+    return data
+
+
+class OcrImagesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # The module-level semaphore would bind to the first test's loop.
+        for target in (
+            patch.object(app, "_ocr_semaphore", asyncio.Semaphore(4)),
+            patch.object(app.ocr_engine, "drop_score", 0.5),
+            patch("app._preprocess", side_effect=lambda data: data),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    async def run_ocr(self, detections, cls=None):
+        # Each image's bytes name its detection; recognition echoes each crop.
+        def detect(data):
+            boxes = detections[data]
+            return boxes, [f"{data}:{i}" for i in range(len(boxes))]
+
+        with patch("app._detect", side_effect=detect), patch(
+            "app._recognize", side_effect=lambda crops, use_cls: [(crop, 0.9) for crop in crops]
+        ) as recognize:
+            response = await app._ocr_images(
+                list(detections), [source(data) for data in detections], cls
+            )
+        return json.loads(response.body), recognize
+
+    async def test_splits_recognition_back_per_image(self):
+        body, recognize = await self.run_ocr(
+            {"front": [box(0), box(2)], "blank": [], "back": [box(4)]}
+        )
+
+        recognize.assert_called_once()
+        self.assertEqual(recognize.call_args.args[0], ["front:0", "front:1", "back:0"])
+        results = {result["id"]: result for result in body["results"]}
+        self.assertEqual([result["id"] for result in body["results"]], ["front", "blank", "back"])
+        self.assertEqual(results["front"]["text"], "front:0\nfront:1")
+        self.assertEqual(results["blank"]["text"], "")
+        self.assertEqual(results["blank"]["tokens"], [])
+        self.assertEqual(results["back"]["text"], "back:0")
+        self.assertEqual(results["back"]["tokens"][0]["bbox"][0], {"x": 4.0, "y": 0.0})
+        self.assertEqual(results["back"]["tokens"][0]["image_id"], "back")
+        self.assertEqual(body["combined_text"], "[front]\nfront:0\nfront:1\n\n[back]\nback:0")
+
+    async def test_cls_defaults_to_deployment_setting(self):
+        _, recognize = await self.run_ocr({"front": [box(0)]})
+
+        self.assertEqual(recognize.call_args.args[1], app.OCR_USE_ANGLE_CLS)
+
+    async def test_cls_request_override(self):
+        for cls in (True, False):
+            with self.subTest(cls=cls):
+                _, recognize = await self.run_ocr({"front": [box(0)]}, cls=cls)
+
+                self.assertIs(recognize.call_args.args[1], cls)
+
+
+class ParseResultTest(unittest.TestCase):
+    def test_drops_empty_and_low_confidence_lines(self):
+        rec_res = [("TOPPS", 0.9), ("", 0.99), ("smudge", 0.3), ("2026", 0.7)]
+        with patch.object(app.ocr_engine, "drop_score", 0.5):
+            result = app._parse_result([box(i) for i in range(4)], rec_res, "front")
+
+        self.assertEqual(result["text"], "TOPPS\n2026")
+        self.assertEqual([token["text"] for token in result["tokens"]], ["TOPPS", "2026"])
+        self.assertAlmostEqual(result["confidence"], 0.8)
+
+    def test_no_lines_has_zero_confidence(self):
+        with patch.object(app.ocr_engine, "drop_score", 0.5):
+            result = app._parse_result([box(0)], [("smudge", 0.1)], "front")
+
+        self.assertEqual(result, {"id": "front", "text": "", "confidence": 0.0, "tokens": []})
+
+
+class FetchWaitTest(unittest.TestCase):
+    def retry_state(self, headers):
+        request = httpx.Request("GET", "https://images.example/card.jpg")
+        response = httpx.Response(503, headers=headers, request=request)
+        state = MagicMock(attempt_number=1)
+        state.outcome.exception.return_value = httpx.HTTPStatusError(
+            "unavailable", request=request, response=response
+        )
+        return state
+
+    def test_honours_retry_after(self):
+        self.assertEqual(app._fetch_wait(self.retry_state({"Retry-After": "2"})), 2.0)
+
+    def test_caps_retry_after(self):
+        wait = app._fetch_wait(self.retry_state({"Retry-After": "3600"}))
+
+        self.assertEqual(wait, app.FETCH_BACKOFF_MAX)
+
+    def test_caps_retry_after_date(self):
+        wait = app._fetch_wait(self.retry_state({"Retry-After": "Fri, 31 Dec 2100 23:59:59 GMT"}))
+
+        self.assertEqual(wait, app.FETCH_BACKOFF_MAX)
+
+    def test_backs_off_without_retry_after(self):
+        wait = app._fetch_wait(self.retry_state({}))
+
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, app.FETCH_BACKOFF_MAX)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,59 @@
 import base64
 import io
+import json
 import os
+import threading
+from contextlib import contextmanager
 from typing import Optional, Tuple, List
 
 import cv2
 import numpy as np
 import requests
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+
+    _jpeg = TurboJPEG()
+except Exception:
+    # PyTurboJPEG is optional; without libturbojpeg we encode with OpenCV.
+    _jpeg = None
 
 app = FastAPI()
 
 TARGET_W = int(os.getenv("VARIANT_CORNER_TARGET_W", "800"))
 TARGET_H = int(os.getenv("VARIANT_CORNER_TARGET_H", "1100"))
+DETECT_W = int(os.getenv("VARIANT_CORNER_DETECT_W", "1024"))
+CARD_ASPECT = max(TARGET_W, TARGET_H) / float(min(TARGET_W, TARGET_H))
+
+class CappedRetry(Retry):
+    # urllib3 sleeps for the full Retry-After, which backoff_max does not
+    # bound; honour the header but cap the wait at backoff_max.
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=CappedRetry(
+        total=3,
+        backoff_factor=0.25,
+        backoff_jitter=0.25,
+        backoff_max=4,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
 
 class NormalizeRequest(BaseModel):
     imageUrl: Optional[str] = None
@@ -31,36 +72,86 @@ def fetch_image(req: NormalizeRequest) -> np.ndarray:
         data = base64.b64decode(req.imageBase64)
         return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
     if req.imageUrl:
-        resp = requests.get(req.imageUrl, timeout=10)
+        resp = _session.get(req.imageUrl, timeout=10)
         resp.raise_for_status()
         return cv2.imdecode(np.frombuffer(resp.content, np.uint8), cv2.IMREAD_COLOR)
     raise ValueError("Missing imageUrl or imageBase64")
 
 
 def order_points(pts: np.ndarray) -> np.ndarray:
-    rect = np.zeros((4, 2), dtype="float32")
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]
-    rect[2] = pts[np.argmax(s)]
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
-    return rect
+    # Four points are too few for numpy to pay off; plain floats avoid the
+    # per-op dispatch and temporary arrays.
+    pts = [(float(x), float(y)) for x, y in pts]
+    s = [x + y for x, y in pts]
+    diff = [x - y for x, y in pts]
+    tl = pts[s.index(min(s))]
+    br = pts[s.index(max(s))]
+    tr = pts[diff.index(max(diff))]
+    bl = pts[diff.index(min(diff))]
+    return np.array([tl, tr, br, bl], dtype="float32")
+
+
+# Gray/blur/edge buffer sets shared by the threadpool that serves the sync
+# endpoints. Detection runs at most DETECT_W wide and at most
+# SCRATCH_POOL_SIZE idle sets are kept, so reuse stays bounded however many
+# threads serve requests.
+SCRATCH_POOL_SIZE = 4
+_scratch_lock = threading.Lock()
+_scratch_pool: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+
+@contextmanager
+def scratch_buffers(shape: Tuple[int, int]):
+    buffers = None
+    with _scratch_lock:
+        for i, candidate in enumerate(_scratch_pool):
+            if candidate[0].shape == shape:
+                buffers = _scratch_pool.pop(i)
+                break
+    if buffers is None:
+        buffers = tuple(np.empty(shape, dtype=np.uint8) for _ in range(3))
+    try:
+        yield buffers
+    finally:
+        with _scratch_lock:
+            _scratch_pool.append(buffers)
+            if len(_scratch_pool) > SCRATCH_POOL_SIZE:
+                _scratch_pool.pop(0)
 
 
 def find_card_corners(image: np.ndarray) -> Optional[np.ndarray]:
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (5, 5), 0)
-    edges = cv2.Canny(blur, 50, 150)
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Search for the quad on a downscaled copy; the corners are mapped back to
+    # full resolution so the warp still samples the original image.
+    scale = min(1.0, DETECT_W / float(image.shape[1]))
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    with scratch_buffers(image.shape[:2]) as (gray, blur, edges):
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.GaussianBlur(gray, (5, 5), 0, dst=blur)
+        cv2.Canny(blur, 50, 150, edges=edges)
+        # findContours copies what it returns, so the buffers can go back now.
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
         return None
     contours = sorted(contours, key=cv2.contourArea, reverse=True)
+
+    # Fast path: when the largest contour is already a card-shaped rectangle
+    # filling a good part of the frame, its min-area rect is the answer. The
+    # fill check keeps perspective-skewed quads on the approxPolyDP path.
+    rect = cv2.minAreaRect(contours[0])
+    short_side, long_side = sorted(rect[1])
+    if (
+        short_side > 0.3 * min(image.shape[:2])
+        and abs(long_side / short_side - CARD_ASPECT) <= 0.1 * CARD_ASPECT
+        and cv2.contourArea(contours[0]) >= 0.95 * short_side * long_side
+    ):
+        return cv2.boxPoints(rect) / scale
+
     for cnt in contours[:5]:
         peri = cv2.arcLength(cnt, True)
         approx = cv2.approxPolyDP(cnt, 0.02 * peri, True)
         if len(approx) == 4:
-            return approx.reshape(4, 2)
+            return approx.reshape(4, 2) / scale
     return None
 
 
@@ -83,9 +174,22 @@ def fallback_bbox(image: np.ndarray) -> np.ndarray:
     return cv2.resize(crop, (TARGET_W, TARGET_H))
 
 
-def encode_image(image: np.ndarray) -> str:
+def encode_jpeg(image: np.ndarray) -> bytes:
+    if _jpeg is not None:
+        return _jpeg.encode(image, quality=85, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
     _, buf = cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), 85])
-    return base64.b64encode(buf).decode("utf-8")
+    return buf.tobytes()
+
+
+def encode_image(image: np.ndarray) -> str:
+    return base64.b64encode(encode_jpeg(image)).decode("ascii")
+
+
+def normalize_image(image: np.ndarray) -> Tuple[np.ndarray, str, Optional[List[Tuple[int, int]]]]:
+    corners = find_card_corners(image)
+    if corners is not None:
+        return warp_perspective(image, corners), "perspective", [(int(x), int(y)) for x, y in corners]
+    return fallback_bbox(image), "bbox", None
 
 
 @app.post("/normalize", response_model=NormalizeResponse)
@@ -98,22 +202,31 @@ def normalize(req: NormalizeRequest):
     if image is None:
         raise HTTPException(status_code=400, detail="Invalid image data")
 
-    corners = find_card_corners(image)
-    if corners is not None:
-        warped = warp_perspective(image, corners)
-        return {
-            "normalizedBase64": encode_image(warped),
-            "width": TARGET_W,
-            "height": TARGET_H,
-            "method": "perspective",
-            "corners": [(int(x), int(y)) for x, y in corners],
-        }
-
-    warped = fallback_bbox(image)
+    warped, method, corners = normalize_image(image)
     return {
         "normalizedBase64": encode_image(warped),
         "width": TARGET_W,
         "height": TARGET_H,
-        "method": "bbox",
-        "corners": None,
+        "method": method,
+        "corners": corners,
     }
+
+
+def normalize_raw_image(data: bytes) -> Response:
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if data else None
+    if image is None:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+
+    warped, method, corners = normalize_image(image)
+    headers = {"X-Method": method, "X-Width": str(TARGET_W), "X-Height": str(TARGET_H)}
+    if corners is not None:
+        headers["X-Corners"] = json.dumps(corners)
+    return Response(content=encode_jpeg(warped), media_type="image/jpeg", headers=headers)
+
+
+@app.post("/normalize/raw")
+async def normalize_raw(request: Request):
+    # Internal callers can post the encoded image as the request body and get
+    # the JPEG back directly, skipping the base64 round-trip both ways.
+    data = await request.body()
+    return await run_in_threadpool(normalize_raw_image, data)
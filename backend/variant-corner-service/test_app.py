@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+
+import app
+
+
+def reference_order_points(pts: np.ndarray) -> np.ndarray:
+    # The numpy implementation order_points replaced.
+    rect = np.zeros((4, 2), dtype="float32")
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]
+    rect[2] = pts[np.argmax(s)]
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)]
+    rect[3] = pts[np.argmax(diff)]
+    return rect
+
+
+def card_image(width, height, quad):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    cv2.fillPoly(image, [np.array(quad, dtype=np.int32)], (255, 255, 255))
+    return image
+
+
+def rect_quad(x, y, w, h):
+    return [(x, y), (x + w - 1, y), (x + w - 1, y + h - 1), (x, y + h - 1)]
+
+
+class OrderPointsTest(unittest.TestCase):
+    def test_matches_numpy_ordering(self):
+        rng = np.random.default_rng(0)
+        cases = [rng.integers(0, 1000, (4, 2)).astype(np.float32) for _ in range(200)]
+        # Ties on x + y and x - y, where argmin/argmax take the first index.
+        cases.append(np.float32([[5, 0], [10, 5], [5, 10], [0, 5]]))
+        cases.append(np.float32([[0, 0], [0, 0], [4, 4], [4, 4]]))
+        cases.append(np.float32([[3, 3], [1, 1], [2, 2], [0, 0]]))
+        for pts in cases:
+            with self.subTest(pts=pts.tolist()):
+                np.testing.assert_array_equal(app.order_points(pts), reference_order_points(pts))
+
+
+class FindCardCornersTest(unittest.TestCase):
+    def find_corners(self, image):
+        with patch("app.cv2.approxPolyDP", wraps=cv2.approxPolyDP) as approx:
+            corners = app.find_card_corners(image)
+        self.assertIsNotNone(corners)
+        return app.order_points(corners), approx
+
+    def test_frontal_card_takes_min_area_rect_path(self):
+        quad = rect_quad(300, 200, 400, 550)
+
+        corners, approx = self.find_corners(card_image(1000, 1000, quad))
+
+        approx.assert_not_called()
+        np.testing.assert_allclose(corners, np.float32(quad), atol=3)
+
+    def test_skewed_card_falls_through_to_polygon_approximation(self):
+        quad = [(400, 150), (600, 150), (750, 850), (250, 850)]
+
+        corners, approx = self.find_corners(card_image(1000, 1000, quad))
+
+        approx.assert_called()
+        # Blur and Canny round the acute corners by a few pixels.
+        np.testing.assert_allclose(corners, np.float32(quad), atol=5)
+
+    def test_corners_map_back_to_full_resolution(self):
+        quad = rect_quad(900, 375, 1200, 1650)
+        image = card_image(3000, 2400, quad)
+        self.assertGreater(image.shape[1], app.DETECT_W)
+
+        corners, _ = self.find_corners(image)
+
+        # One detection pixel is about three full-resolution pixels here.
+        np.testing.assert_allclose(corners, np.float32(quad), atol=10)
+
+    def test_scratch_pool_stays_bounded(self):
+        for width in range(400, 400 + 20 * (app.SCRATCH_POOL_SIZE + 2), 20):
+            app.find_card_corners(card_image(width, 600, rect_quad(50, 50, 200, 275)))
+
+        self.assertLessEqual(len(app._scratch_pool), app.SCRATCH_POOL_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,34 +1,122 @@
+import asyncio
 import base64
 import io
 import os
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
 
+import numpy as np
 import requests
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from PIL import Image
 import torch
-from torchvision import transforms
-
-app = FastAPI()
+import torch.nn.functional as F
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 MODEL_NAME = os.getenv("VARIANT_DINOV2_MODEL", "dinov2_vits14")
 DEVICE = os.getenv("VARIANT_EMBEDDING_DEVICE", "cpu")
+MAX_BATCH = int(os.getenv("VARIANT_MAX_BATCH", "32"))
+MAX_WAIT_MS = int(os.getenv("VARIANT_MAX_WAIT_MS", "10"))
+PRECISION = os.getenv("VARIANT_EMBEDDING_PRECISION", "fp16" if DEVICE.startswith("cuda") else "fp32").lower()
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+if PRECISION not in DTYPES:
+    raise ValueError(
+        f"Unsupported VARIANT_EMBEDDING_PRECISION {PRECISION!r}; expected one of {', '.join(DTYPES)}"
+    )
+DTYPE = DTYPES[PRECISION]
+TRACE = os.getenv("VARIANT_EMBEDDING_TRACE", "true").lower() in ("1", "true", "yes")
+COMPILE = os.getenv(
+    "VARIANT_EMBEDDING_COMPILE", "true" if DEVICE.startswith("cuda") else "false"
+).lower() in ("1", "true", "yes") and hasattr(torch, "compile")
+# A compiled model is specialized per batch size, so forward passes are padded
+# up to one of these sizes: powers of two below MAX_BATCH, then MAX_BATCH.
+BATCH_SIZES = sorted({MAX_BATCH, *(1 << i for i in range(MAX_BATCH.bit_length()) if 1 << i < MAX_BATCH)})
+
+# Allow TF32 matmuls on Ampere+ GPUs for any fp32 work.
+torch.set_float32_matmul_precision("high")
 
 _model = None
+_queue: Optional[asyncio.Queue] = None
+# Every forward pass runs on this one thread, in submission order.
+_model_pool = ThreadPoolExecutor(max_workers=1)
+
+class CappedRetry(Retry):
+    # urllib3 sleeps for the full Retry-After, which backoff_max does not
+    # bound; honour the header but cap the wait at backoff_max.
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=CappedRetry(
+        total=3,
+        backoff_factor=0.25,
+        backoff_jitter=0.25,
+        backoff_max=4,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+MEAN = torch.tensor((0.485, 0.456, 0.406)).view(3, 1, 1)
+STD = torch.tensor((0.229, 0.224, 0.225)).view(3, 1, 1)
+
+
+def build_model():
+    model = torch.hub.load("facebookresearch/dinov2", MODEL_NAME)
+    model.eval()
+    model.to(DEVICE, dtype=DTYPE)
+    if COMPILE:
+        # torch.compile supersedes the TorchScript trace when both are enabled.
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+    elif TRACE:
+        example = torch.randn(1, 3, 224, 224, device=DEVICE, dtype=DTYPE)
+        with torch.no_grad():
+            model = torch.jit.trace(model, example, check_trace=False)
+    return model
+
 
+def warmup_model(model, runs: int = 3):
+    # Warm kernels and an initialized CUDA context for the first real requests.
+    # A compiled model gets a graph captured for every padded batch size
+    # forward can produce; otherwise one image's crops and a full batch.
+    for batch_size in BATCH_SIZES if COMPILE else sorted({7, MAX_BATCH}):
+        dummy = torch.zeros(batch_size, 3, 224, 224, device=DEVICE, dtype=DTYPE)
+        with torch.inference_mode():
+            for _ in range(runs):
+                model(dummy)
 
-def load_model():
-    global _model
-    if _model is None:
-        _model = torch.hub.load("facebookresearch/dinov2", MODEL_NAME)
-        _model.eval()
-        _model.to(DEVICE)
-    return _model
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global _model, _queue
+    loop = asyncio.get_running_loop()
+    _model = await loop.run_in_executor(_model_pool, build_model)
+    await loop.run_in_executor(_model_pool, warmup_model, _model)
+    _queue = asyncio.Queue()
+    worker = asyncio.create_task(batch_worker(_queue))
+    try:
+        yield
+    finally:
+        await stop_batch_worker(worker, _queue)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def fetch_image(image_url: str) -> Image.Image:
-    resp = requests.get(image_url, timeout=10)
+    resp = _session.get(image_url, timeout=10)
     resp.raise_for_status()
     return Image.open(io.BytesIO(resp.content)).convert("RGB")
 
@@ -60,17 +148,16 @@ class BatchEmbedResponse(BaseModel):
 
 @app.get("/health")
 def health():
-    return { "ok": True, "model": MODEL_NAME, "device": DEVICE }
+    return { "ok": True, "model": MODEL_NAME, "device": DEVICE, "precision": PRECISION }
 
 
-def build_crops(img: Image.Image):
-    w, h = img.size
+def crop_boxes(w: int, h: int) -> List[Tuple[str, Tuple[int, int, int, int]]]:
     strip_h = max(40, int(h * 0.12))
     strip_w = max(40, int(w * 0.12))
     center_w = max(80, int(w * 0.4))
     center_h = max(80, int(h * 0.4))
 
-    crops = [
+    return [
         ("top", (0, 0, w, strip_h)),
         ("bottom", (0, h - strip_h, w, h)),
         ("left", (0, 0, strip_w, h)),
@@ -87,61 +174,170 @@ def build_crops(img: Image.Image):
         ),
         ("holo", (int(w * 0.2), int(h * 0.2), int(w * 0.2) + int(w * 0.5), int(h * 0.2) + int(h * 0.5))),
     ]
-    return [(label, img.crop(box)) for label, box in crops]
 
 
-def embed_image(img: Image.Image):
-    model = load_model()
-    preprocess = transforms.Compose(
-        [
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
-        ]
-    )
-    tensor = preprocess(img).unsqueeze(0).to(DEVICE)
-    with torch.no_grad():
-        vec = model(tensor)
-    if isinstance(vec, (list, tuple)):
-        vec = vec[0]
-    vec = vec.squeeze(0).cpu().numpy().tolist()
-    return vec
+def crop_arrays(img: Image.Image) -> List[Tuple[str, np.ndarray]]:
+    # Slices one uint8 array instead of cropping through PIL.
+    arr = np.array(img)
+    h, w = arr.shape[:2]
+    boxes = crop_boxes(w, h)
+
+    # PIL fills crop regions outside the image with black; pad once so the
+    # slices below see the same pixels.
+    left = max(0, -min(box[0] for _, box in boxes))
+    top = max(0, -min(box[1] for _, box in boxes))
+    right = max(0, max(box[2] for _, box in boxes) - w)
+    bottom = max(0, max(box[3] for _, box in boxes) - h)
+    if left or top or right or bottom:
+        arr = np.pad(arr, ((top, bottom), (left, right), (0, 0)))
+    return [(label, arr[y1 + top : y2 + top, x1 + left : x2 + left]) for label, (x1, y1, x2, y2) in boxes]
+
+
+def build_crops(img: Image.Image) -> Tuple[List[str], torch.Tensor]:
+    # Converts all crops to a normalized (N, 3, 224, 224) tensor in one pass.
+    crops = crop_arrays(img)
+
+    # Antialiased bilinear rounded back to 0-255 matches torchvision's
+    # Resize((224, 224)) on a PIL image, which the stored reference
+    # embeddings were computed with; cv2 INTER_AREA only antialiases when both
+    # axes shrink, and the edge strips are upscaled on one axis.
+    resized = [
+        F.interpolate(
+            torch.from_numpy(crop).permute(2, 0, 1).unsqueeze(0).float(),
+            size=(224, 224),
+            mode="bilinear",
+            align_corners=False,
+            antialias=True,
+        )
+        for _, crop in crops
+    ]
+    tensor = torch.cat(resized).round_().clamp_(0, 255).div_(255).sub_(MEAN).div_(STD)
+    return [label for label, _ in crops], tensor
+
+
+def forward(tensor: torch.Tensor) -> List[List[float]]:
+    vectors: List[List[float]] = []
+    for start in range(0, tensor.shape[0], MAX_BATCH):
+        chunk = tensor[start : start + MAX_BATCH]
+        rows = chunk.shape[0]
+        if COMPILE:
+            size = next(size for size in BATCH_SIZES if size >= rows)
+            if size > rows:
+                chunk = torch.cat([chunk, chunk.new_zeros((size - rows, *chunk.shape[1:]))])
+        chunk = chunk.to(DEVICE, dtype=DTYPE)
+        with torch.inference_mode():
+            out = _model(chunk)
+        if isinstance(out, (list, tuple)):
+            out = out[0]
+        vectors.extend(out[:rows].float().cpu().numpy().tolist())
+    return vectors
+
+
+async def collect_batch(queue: asyncio.Queue, batch: list) -> list:
+    # Block for the first job, then keep taking jobs until MAX_BATCH crops are
+    # queued or MAX_WAIT_MS has passed since the first one arrived. Jobs are
+    # appended to the caller's list so they can still be failed on cancel.
+    loop = asyncio.get_running_loop()
+    batch.append(await queue.get())
+    rows = batch[0][0].shape[0]
+    deadline = loop.time() + MAX_WAIT_MS / 1000
+    while rows < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            job = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        batch.append(job)
+        rows += job[0].shape[0]
+    return batch
+
+
+def fail_jobs(jobs: list, exc: BaseException):
+    for _, fut in jobs:
+        if not fut.done():
+            fut.set_exception(exc)
+
+
+async def batch_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch: list = []
+        try:
+            await collect_batch(queue, batch)
+            tensor = torch.cat([tensor for tensor, _ in batch])
+            vectors = await loop.run_in_executor(_model_pool, forward, tensor)
+        except asyncio.CancelledError:
+            fail_jobs(batch, RuntimeError("Embedding worker stopped"))
+            raise
+        except Exception as exc:
+            fail_jobs(batch, exc)
+            continue
+        offset = 0
+        for tensor, fut in batch:
+            count = tensor.shape[0]
+            if not fut.done():
+                fut.set_result(vectors[offset : offset + count])
+            offset += count
+
+
+async def stop_batch_worker(worker: asyncio.Task, queue: asyncio.Queue):
+    # Cancel the worker (failing the batch it holds), then fail every job still
+    # queued so no request waits forever on shutdown.
+    worker.cancel()
+    try:
+        await worker
+    except asyncio.CancelledError:
+        pass
+    pending = []
+    while not queue.empty():
+        pending.append(queue.get_nowait())
+    fail_jobs(pending, RuntimeError("Embedding worker stopped"))
+
+
+async def embed_crops(tensor: torch.Tensor) -> List[List[float]]:
+    fut = asyncio.get_running_loop().create_future()
+    # Contiguous NCHW like the warmup batches, so the compiled model is not
+    # re-specialized on input strides.
+    await _queue.put((tensor.contiguous(), fut))
+    return await fut
+
+
+def crop_embeddings(labels: List[str], vectors: List[List[float]]) -> List[dict]:
+    return [{"cropUrl": f"crop:{label}", "vector": vec} for label, vec in zip(labels, vectors)]
 
 
 @app.post("/embed", response_model=EmbedResponse)
-def embed(req: EmbedRequest):
+async def embed(req: EmbedRequest):
     try:
         if req.imageBase64:
-            img = image_from_base64(req.imageBase64)
+            img = await run_in_threadpool(image_from_base64, req.imageBase64)
         elif req.imageUrl:
-            img = fetch_image(req.imageUrl)
+            img = await run_in_threadpool(fetch_image, req.imageUrl)
         else:
             raise HTTPException(status_code=400, detail="imageUrl or imageBase64 required")
     except Exception as exc:
         raise HTTPException(status_code=400, detail=str(exc))
 
-    embeddings = []
-    for label, crop in build_crops(img):
-        vec = embed_image(crop)
-        embeddings.append({"cropUrl": f"crop:{label}", "vector": vec})
-
+    labels, tensor = await run_in_threadpool(build_crops, img)
     return {
         "cropUrls": [],
-        "embeddings": embeddings,
+        "embeddings": crop_embeddings(labels, await embed_crops(tensor)),
     }
 
 
 @app.post("/embed/batch", response_model=BatchEmbedResponse)
-def embed_batch(req: BatchEmbedRequest):
-    results: List[EmbedResponse] = []
-    for image_url in req.imageUrls:
+async def embed_batch(req: BatchEmbedRequest):
+    # Each image is queued as its own job; the batch worker merges them (and
+    # any concurrent /embed calls) into shared forward passes.
+    async def embed_url(image_url: str) -> dict:
         try:
-            img = fetch_image(image_url)
-            embeddings = []
-            for label, crop in build_crops(img):
-                vec = embed_image(crop)
-                embeddings.append({ "cropUrl": f"crop:{label}", "vector": vec })
-            results.append({ "cropUrls": [], "embeddings": embeddings })
+            img = await run_in_threadpool(fetch_image, image_url)
+            labels, tensor = await run_in_threadpool(build_crops, img)
+            vectors = await embed_crops(tensor)
         except Exception:
-            results.append({ "cropUrls": [], "embeddings": [] })
-    return { "results": results }
+            return { "cropUrls": [], "embeddings": [] }
+        return { "cropUrls": [], "embeddings": crop_embeddings(labels, vectors) }
+
+    return { "results": await asyncio.gather(*[embed_url(image_url) for image_url in req.imageUrls]) }
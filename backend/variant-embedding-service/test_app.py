@@ -0,0 +1,131 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import torch
+from PIL import Image
+
+import app
+
+
+def fake_forward(tensor):
+    # Row i of the merged batch embeds to [i], so each job's slice shows which
+    # rows it was handed.
+    return [[float(i)] for i in range(tensor.shape[0])]
+
+
+class BatchWorkerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def job(self, rows):
+        return torch.zeros(rows, 1), self.loop.create_future()
+
+    async def run_jobs(self, jobs):
+        for job in jobs:
+            self.queue.put_nowait(job)
+        worker = asyncio.create_task(app.batch_worker(self.queue))
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*[fut for _, fut in jobs], return_exceptions=True), timeout=5
+            )
+        finally:
+            await app.stop_batch_worker(worker, self.queue)
+
+    async def test_splits_vectors_by_job_offset(self):
+        with patch("app.forward", side_effect=fake_forward) as forward:
+            first, second = await self.run_jobs([self.job(3), self.job(5)])
+
+        forward.assert_called_once()
+        self.assertEqual(forward.call_args.args[0].shape[0], 8)
+        self.assertEqual(first, [[0.0], [1.0], [2.0]])
+        self.assertEqual(second, [[3.0], [4.0], [5.0], [6.0], [7.0]])
+
+    async def test_forward_error_fails_every_job(self):
+        with patch("app.forward", side_effect=RuntimeError("boom")):
+            results = await self.run_jobs([self.job(3), self.job(5)])
+
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+            self.assertEqual(str(result), "boom")
+
+    async def test_skips_cancelled_futures(self):
+        cancelled, kept = self.job(3), self.job(2)
+        cancelled[1].cancel()
+        with patch("app.forward", side_effect=fake_forward):
+            results = await self.run_jobs([cancelled, kept])
+
+        self.assertIsInstance(results[0], asyncio.CancelledError)
+        self.assertEqual(results[1], [[3.0], [4.0]])
+
+    async def test_stop_fails_collected_job(self):
+        job = self.job(3)
+        with patch("app.MAX_WAIT_MS", 60_000), patch("app.forward", side_effect=fake_forward) as forward:
+            worker = asyncio.create_task(app.batch_worker(self.queue))
+            self.queue.put_nowait(job)
+            # Let the worker take the job and wait for more crops.
+            await asyncio.sleep(0.01)
+            self.assertTrue(self.queue.empty())
+            await app.stop_batch_worker(worker, self.queue)
+
+        forward.assert_not_called()
+        self.assertIsInstance(job[1].exception(), RuntimeError)
+
+    async def test_stop_fails_queued_jobs(self):
+        jobs = [self.job(3), self.job(5)]
+        worker = asyncio.create_task(app.batch_worker(self.queue))
+        for job in jobs:
+            self.queue.put_nowait(job)
+        await app.stop_batch_worker(worker, self.queue)
+
+        self.assertTrue(self.queue.empty())
+        for _, fut in jobs:
+            self.assertIsInstance(fut.exception(), RuntimeError)
+
+
+class ForwardTest(unittest.TestCase):
+    def test_compiled_forward_pads_to_batch_sizes(self):
+        sizes = []
+
+        def model(chunk):
+            sizes.append(chunk.shape[0])
+            return torch.arange(chunk.shape[0], dtype=torch.float32).unsqueeze(1)
+
+        with patch("app._model", side_effect=model), patch("app.COMPILE", True), patch(
+            "app.MAX_BATCH", 32
+        ), patch("app.BATCH_SIZES", [1, 2, 4, 8, 16, 32]), patch("app.DEVICE", "cpu"), patch(
+            "app.DTYPE", torch.float32
+        ):
+            vectors = app.forward(torch.zeros(39, 3, 4, 4))
+
+        self.assertEqual(sizes, [32, 8])
+        self.assertEqual(vectors, [[float(i)] for i in range(32)] + [[float(i)] for i in range(7)])
+
+
+class CropTest(unittest.TestCase):
+    def test_crops_match_pil_past_the_edge(self):
+        # At 100x100 the center and stamp boxes run past the right and bottom
+        # edges, where PIL's crop fills with black.
+        pixels = np.random.default_rng(0).integers(0, 256, (100, 100, 3), dtype=np.uint8)
+        img = Image.fromarray(pixels)
+        boxes = app.crop_boxes(100, 100)
+        self.assertTrue(any(x2 > 100 or y2 > 100 for _, (_, _, x2, y2) in boxes))
+
+        crops = app.crop_arrays(img)
+
+        self.assertEqual([label for label, _ in crops], [label for label, _ in boxes])
+        for (label, crop), (_, box) in zip(crops, boxes):
+            with self.subTest(label=label):
+                np.testing.assert_array_equal(crop, np.asarray(img.crop(box)))
+
+    def test_build_crops_shape(self):
+        labels, tensor = app.build_crops(Image.new("RGB", (100, 100)))
+
+        self.assertEqual(len(labels), 7)
+        self.assertEqual(tuple(tensor.shape), (7, 3, 224, 224))
+
+
+if __name__ == "__main__":
+    unittest.main()